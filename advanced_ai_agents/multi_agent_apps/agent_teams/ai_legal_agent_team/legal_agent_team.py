@@ -1,14 +1,42 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from agno.agent import Agent
-from agno.run.agent import RunOutput
+from agno.run.team import TeamRunEvent
 from agno.team import Team
 from agno.knowledge.knowledge import Knowledge
 from agno.vectordb.qdrant import Qdrant
 from agno.tools.duckduckgo import DuckDuckGoTools
 from agno.models.openai import OpenAIChat
 from agno.knowledge.embedder.openai import OpenAIEmbedder
-import tempfile
+from qdrant_client import models
+import fitz  # PyMuPDF
+import numpy as np
+from numba import njit
+from dataclasses import dataclass
+from collections import OrderedDict
+import diskcache
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+import threading
+import io
 import os
+import asyncio
+import time
+import uuid
+import hashlib
+import re
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
 
 def init_session_state():
     """Initialize session state variables"""
@@ -28,34 +56,477 @@ def init_session_state():
     if 'processed_files' not in st.session_state:
         st.session_state.processed_files = set()
 
+def set_openai_key_once():
+    """Export the OpenAI key only when it changed, so reruns don't churn os.environ"""
+    key = st.session_state.openai_api_key
+    if key and os.environ.get('OPENAI_API_KEY') != key:
+        os.environ['OPENAI_API_KEY'] = key
+
 COLLECTION_NAME = "legal_documents"  # Define your collection name
+EMBEDDING_DIMENSIONS = 512  # Truncated text-embedding-3-small vectors (model default is 1536)
+EMBEDDING_BATCH_SIZE = 256  # Max chunks per embeddings request
+EMBEDDING_CONCURRENCY = 8  # Embeddings requests in flight at once, across all ingests
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # Query embeddings kept in memory per embedder
+QUERY_EMBEDDING_CACHE_DIR = os.path.expanduser("~/.cache/legalteam/qemb")  # Survives Streamlit restarts
+QUERY_EMBEDDING_CACHE_SIZE_LIMIT = 1 << 26  # Bytes on disk before the oldest entries are evicted
+HNSW_CONFIG = models.HnswConfigDiff(m=32, ef_construct=256)  # ANN graph for legal_documents
+QUANTIZATION_CONFIG = models.ScalarQuantization(  # int8 copies in RAM, float originals kept for rescoring
+    scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+)
+VECTORS_CONFIG = {"": models.VectorParamsDiff(on_disk=True)}  # Float originals are only read when rescoring
+CHUNK_SIZE = 2000  # Max characters per chunk, split on sentence boundaries
+CHUNK_OVERLAP = 200  # Trailing sentences (up to this many characters) repeated at the start of the next chunk
+SENTENCE_END = re.compile(r"[.!?]\s+")
+SIMHASH_MAX_DISTANCE = 3  # Chunks within this many differing SimHash bits count as duplicates
+OCR_MIN_CHARS = 50  # Pages with less extractable text than this are treated as scanned
+OCR_DPI = 200  # Render resolution for pages sent to OCR
+INGEST_WORKERS = 8  # Chunk batches being embedded and upserted at once
+UPSERT_BATCH_SIZE = 256  # Points per Qdrant upsert request
+QA_CACHE_COLLECTION = "legal_qa_cache"  # Semantic cache of previous analyses
+QA_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity to reuse a cached analysis
+QA_CACHE_TTL_SECONDS = 7 * 24 * 3600  # Cached analyses older than this are not reused
+AGENT_REQUESTS_PER_SECOND = 3.0  # Sustained rate of agent runs started against OpenAI
+AGENT_MAX_BURST = 8  # Agent runs allowed to start (and be in flight) at once
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)  # OpenAI SDK's read timeout; long non-streamed reasoning replies need it
+
+@dataclass
+class TokenBatchedOpenAIEmbedder(OpenAIEmbedder):
+    """OpenAIEmbedder that packs chunks into token-budgeted batch requests and caches query embeddings"""
+    enable_batch: bool = True
+    max_batch_tokens: int = 7500
+    max_batch_inputs: int = 2048
+    max_concurrent_requests: int = EMBEDDING_CONCURRENCY
+    query_cache_size: int = QUERY_EMBEDDING_CACHE_SIZE
+    query_cache_dir: str | None = QUERY_EMBEDDING_CACHE_DIR
+
+    def _token_batches(self, texts: list[str]) -> list[list[str]]:
+        """Greedily pack texts into batches under the token and input limits"""
+        encoding = tiktoken.encoding_for_model(self.id)
+        max_inputs = min(self.batch_size, self.max_batch_inputs)
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = len(encoding.encode(text))
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= max_inputs):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _batch_request(self, batch: list[str]) -> dict:
+        request = {"input": batch, "model": self.id, "encoding_format": self.encoding_format}
+        if self.user is not None:
+            request["user"] = self.user
+        if self.id.startswith("text-embedding-3"):
+            request["dimensions"] = self.dimensions
+        if self.request_params:
+            request.update(self.request_params)
+        return request
+
+    def __post_init__(self):
+        if hasattr(super(), "__post_init__"):
+            super().__post_init__()
+        # Shared by every ingest on the background loop, so concurrent documents can't multiply the fan-out
+        self._request_slots = asyncio.Semaphore(self.max_concurrent_requests)
+        # Held on the instance rather than in a module-level lru_cache, which every rerun would reset
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self._disk_cache = (
+            diskcache.Cache(self.query_cache_dir, size_limit=QUERY_EMBEDDING_CACHE_SIZE_LIMIT)
+            if self.query_cache_dir else None
+        )
+
+    def _query_cache_key(self, text: str) -> str:
+        # Hashing the text keeps keys small however long the query is
+        hasher = blake3 if blake3 is not None else hashlib.sha256
+        return f"{self.id}:{self.dimensions}:{hasher(text.encode()).hexdigest()}"
+
+    def _memory_query_embedding(self, key: str):
+        with self._query_cache_lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+        return None
+
+    def _remember_query_embedding(self, key: str, embedding: list[float]):
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def _disk_query_embedding(self, key: str):
+        return self._disk_cache.get(key) if self._disk_cache is not None else None
+
+    def _persist_query_embedding(self, key: str, embedding: list[float]):
+        if self._disk_cache is not None:
+            self._disk_cache.set(key, embedding)
+
+    def get_embedding(self, text: str) -> list[float]:
+        """Query embedding, served from the memory or disk cache when this text was embedded before"""
+        key = self._query_cache_key(text)
+        embedding = self._memory_query_embedding(key)
+        if embedding is None:
+            embedding = self._disk_query_embedding(key)
+            if embedding is None:
+                embedding = super().get_embedding(text)
+                # Failed requests come back empty and shouldn't be cached
+                if embedding:
+                    self._persist_query_embedding(key, embedding)
+            if embedding:
+                self._remember_query_embedding(key, embedding)
+        return embedding
+
+    async def async_get_embedding(self, text: str) -> list[float]:
+        key = self._query_cache_key(text)
+        embedding = self._memory_query_embedding(key)
+        if embedding is None:
+            # diskcache is synchronous SQLite, so it stays off the event loop
+            embedding = await asyncio.to_thread(self._disk_query_embedding, key)
+            if embedding is None:
+                embedding = await super().async_get_embedding(text)
+                if embedding:
+                    await asyncio.to_thread(self._persist_query_embedding, key, embedding)
+            if embedding:
+                self._remember_query_embedding(key, embedding)
+        return embedding
+
+    async def _async_embed_batch(self, batch: list[str]):
+        async with self._request_slots:
+            try:
+                response = await self.aclient.embeddings.create(**self._batch_request(batch))
+            except Exception:
+                response = None
+        if response is None:
+            # Like agno's own batching, a failed batch falls back to one request per text
+            results = [await super(TokenBatchedOpenAIEmbedder, self).async_get_embedding_and_usage(text) for text in batch]
+            return [embedding for embedding, _ in results], [usage for _, usage in results]
+        usage = response.usage.model_dump() if response.usage else None
+        return [data.embedding for data in response.data], [usage] * len(batch)
+
+    async def async_get_embeddings_batch_and_usage(self, texts: list[str]):
+        # Independent requests, so send them concurrently (up to the request limit) and keep the results in order
+        results = await asyncio.gather(*[
+            self._async_embed_batch(batch) for batch in self._token_batches(texts)
+        ])
+        embeddings, usages = [], []
+        for batch_embeddings, batch_usages in results:
+            embeddings.extend(batch_embeddings)
+            usages.extend(batch_usages)
+        return embeddings, usages
+
+@st.cache_resource(show_spinner=False)
+def _build_embedder(openai_key: str) -> TokenBatchedOpenAIEmbedder:
+    """Process-wide embedder so its HTTP client survives Streamlit reruns"""
+    embedder = TokenBatchedOpenAIEmbedder(
+        id="text-embedding-3-small", 
+        api_key=openai_key,
+        dimensions=EMBEDDING_DIMENSIONS,
+        batch_size=EMBEDDING_BATCH_SIZE
+    )
+    # Warm the connection pools and the BPE tables while the connect spinner is showing,
+    # so the first real upload and search don't pay for DNS, TLS and tokenizer loading
+    try:
+        # Ingestion and agent knowledge search use the async client on the background loop, which
+        # is where its connections have to be opened; this call also bypasses the query cache
+        run_in_background(embedder.async_get_embedding_and_usage("warmup"))
+        # The sync client serves the semantic cache lookup in the Analyze handler
+        OpenAIEmbedder.get_embedding(embedder, "warmup")
+        tiktoken.encoding_for_model(embedder.id).encode("warmup")
+    except Exception:
+        pass
+    return embedder
+
+def configure_collection(vector_db: Qdrant):
+    """Create the collection if needed and serve it from a quantized, doc_hash-filterable HNSW index"""
+    vector_db.create()
+    vector_db.client.update_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=VECTORS_CONFIG,
+        hnsw_config=HNSW_CONFIG,
+        quantization_config=QUANTIZATION_CONFIG
+    )
+    # Lets filtered searches and dedup lookups on doc_hash use Qdrant's filterable HNSW
+    vector_db.client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="meta_data.doc_hash",
+        field_schema=models.PayloadSchemaType.KEYWORD
+    )
+
+@st.cache_resource(show_spinner=False)
+def _build_qdrant(qdrant_url: str, qdrant_key: str, openai_key: str) -> Qdrant:
+    """Process-wide Qdrant instance keyed on the credentials it was built with"""
+    # Create Agno's Qdrant instance which implements VectorDb
+    vector_db = Qdrant(
+        collection=COLLECTION_NAME,
+        url=qdrant_url,
+        api_key=qdrant_key,
+        # gRPC avoids JSON (de)serialization of vectors on every search and upsert
+        prefer_grpc=True,
+        grpc_port=6334,
+        embedder=_build_embedder(openai_key)
+    )
+    configure_collection(vector_db)
+    return vector_db
 
 def init_qdrant():
     """Initialize Qdrant client with configured settings."""
     if not all([st.session_state.qdrant_api_key, st.session_state.qdrant_url]):
         return None
     try:
-        # Create Agno's Qdrant instance which implements VectorDb
-        vector_db = Qdrant(
-            collection=COLLECTION_NAME,
-            url=st.session_state.qdrant_url,
-            api_key=st.session_state.qdrant_api_key,
-            embedder=OpenAIEmbedder(
-                id="text-embedding-3-small", 
-                api_key=st.session_state.openai_api_key
-            )
+        return _build_qdrant(
+            st.session_state.qdrant_url,
+            st.session_state.qdrant_api_key,
+            st.session_state.openai_api_key
         )
-        return vector_db
     except Exception as e:
         st.error(f"🔴 Qdrant connection failed: {str(e)}")
         return None
 
-def process_document(uploaded_file, vector_db: Qdrant):
+@st.cache_resource(show_spinner=False, hash_funcs={Qdrant: id})
+def get_knowledge(vector_db: Qdrant) -> Knowledge:
+    """App-wide Knowledge base over the cached Qdrant instance"""
+    return Knowledge(vector_db=vector_db)
+
+@njit(nogil=True, cache=True)
+def _overlap_start(boundaries, i, start, lower):
+    """Earliest sentence boundary before boundaries[i] that is after start and at or past lower"""
+    new_start = boundaries[i - 1]
+    j = i - 2
+    while j >= 0 and boundaries[j] > start and boundaries[j] >= lower:
+        new_start = boundaries[j]
+        j -= 1
+    return new_start
+
+@njit(nogil=True, cache=True)
+def compute_chunks(boundaries, text_length, chunk_size, overlap):
+    """Greedy chunk spans that end on sentence boundaries and stay within chunk_size where possible,
+    each repeating up to overlap characters of whole sentences from the end of the previous one"""
+    n_boundaries = boundaries.shape[0]
+    starts = np.empty(n_boundaries + 1, dtype=np.int64)
+    ends = np.empty(n_boundaries + 1, dtype=np.int64)
+    n = 0
+    start = 0
+    last = 0
+    for i in range(n_boundaries):
+        boundary = boundaries[i]
+        if boundary - start > chunk_size and last > start:
+            starts[n] = start
+            ends[n] = last
+            n += 1
+            # The overlap never pushes the chunk being built past chunk_size
+            start = _overlap_start(boundaries, i, start, max(last - overlap, boundary - chunk_size))
+        last = boundary
+    if text_length - start > chunk_size and last > start:
+        starts[n] = start
+        ends[n] = last
+        n += 1
+        start = _overlap_start(boundaries, n_boundaries, start, max(last - overlap, text_length - chunk_size))
+    if text_length > start:
+        starts[n] = start
+        ends[n] = text_length
+        n += 1
+    return starts[:n], ends[:n]
+
+def split_sentences(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Pack whole sentences into chunks of at most chunk_size characters, overlapping by up to overlap characters"""
+    boundaries = np.fromiter((m.end() for m in SENTENCE_END.finditer(text)), dtype=np.int64)
+    starts, ends = compute_chunks(boundaries, len(text), chunk_size, overlap)
+    return [text[start:end].strip() for start, end in zip(starts, ends)]
+
+_SHINGLE_MIX_1 = np.uint64(0x9E3779B97F4A7C15)
+_SHINGLE_MIX_2 = np.uint64(0xC2B2AE3D27D4EB4F)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+@njit(nogil=True, cache=True)
+def simhash(word_hashes):
+    """64-bit SimHash over the word 3-grams of a chunk"""
+    n = word_hashes.shape[0]
+    if n == 0:
+        return np.uint64(0)
+    votes = np.zeros(64, dtype=np.int64)
+    for i in range(max(n - 2, 1)):
+        h = word_hashes[i]
+        if i + 1 < n:
+            h ^= word_hashes[i + 1] * _SHINGLE_MIX_1
+        if i + 2 < n:
+            h ^= word_hashes[i + 2] * _SHINGLE_MIX_2
+        for bit in range(64):
+            if (h >> np.uint64(bit)) & np.uint64(1):
+                votes[bit] += 1
+            else:
+                votes[bit] -= 1
+    fingerprint = np.uint64(0)
+    for bit in range(64):
+        if votes[bit] > 0:
+            fingerprint |= np.uint64(1) << np.uint64(bit)
+    return fingerprint
+
+@njit(nogil=True, cache=True)
+def _popcount64(x):
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+@njit(nogil=True, cache=True)
+def is_near_duplicate(fingerprint, seen, n_seen, max_distance):
+    """Whether fingerprint is within max_distance bits of any of the first n_seen fingerprints"""
+    for i in range(n_seen):
+        if _popcount64(fingerprint ^ seen[i]) <= max_distance:
+            return True
+    return False
+
+def _word_hash(word: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+
+def dedupe_chunks(chunks: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    """Drop repeated headers, footers and boilerplate that nearly match an earlier chunk"""
+    seen = np.empty(len(chunks), dtype=np.uint64)
+    n_seen = 0
+    kept = []
+    for page_number, chunk in chunks:
+        word_hashes = np.fromiter((_word_hash(word) for word in chunk.lower().split()), dtype=np.uint64)
+        # Numba boxes the uint64 result as a Python int, which would come back in as int64 and
+        # overflow once the top bit is set
+        fingerprint = np.uint64(simhash(word_hashes))
+        if is_near_duplicate(fingerprint, seen, n_seen, SIMHASH_MAX_DISTANCE):
+            continue
+        seen[n_seen] = fingerprint
+        n_seen += 1
+        kept.append((page_number, chunk))
+    return kept
+
+def ocr_page_image(png_bytes: bytes) -> str:
+    """OCR one rendered page with Tesseract"""
+    return pytesseract.image_to_string(Image.open(io.BytesIO(png_bytes)))
+
+def extract_page_texts(pdf_bytes: bytes) -> list[str]:
+    """
+    Extract the text of every page, OCRing only the pages that have no text layer.
+
+    Native-text pages never pay for OCR. Scanned pages are detected by how little
+    text PyMuPDF finds on them and are OCRed concurrently when pytesseract is
+    installed; Tesseract runs as a subprocess, so threads are enough.
     """
-    Process document, create embeddings and store in Qdrant vector database
+    # PyMuPDF parses straight from memory and is far faster than pypdf on large or messy PDFs
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        texts = [page.get_text() for page in pdf]
+        scanned = [i for i, text in enumerate(texts) if len(text.strip()) < OCR_MIN_CHARS]
+        if scanned and pytesseract is not None:
+            images = [pdf[i].get_pixmap(dpi=OCR_DPI).tobytes("png") for i in scanned]
+            with ThreadPoolExecutor() as executor:
+                for i, text in zip(scanned, executor.map(ocr_page_image, images)):
+                    texts[i] = text
+    return texts
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def parse_chunks(pdf_bytes: bytes) -> list[tuple[int, str]]:
+    """Parse a PDF into (page number, chunk) pairs, memoized on the file's bytes"""
+    chunks = []
+    for page_number, page_text in enumerate(extract_page_texts(pdf_bytes), start=1):
+        text = " ".join(page_text.split())
+        chunks.extend((page_number, chunk) for chunk in split_sentences(text))
+    return chunks
+
+async def upsert_chunk_batch(vector_db: Qdrant, batch: list[tuple[int, str]], name: str, doc_hash: str, wait: bool = True):
+    """Embed a batch of chunks and write them to Qdrant in a single upsert"""
+    texts = [chunk for _, chunk in batch]
+    embeddings, usages = await vector_db.embedder.async_get_embeddings_batch_and_usage(texts)
+    # Chunks that failed even as single requests come back empty; a document with gaps must not count as indexed
+    failed = sum(1 for embedding in embeddings if not embedding)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(batch)} chunks of {name} could not be embedded")
+    # Same payload layout as agno's Qdrant.insert, so knowledge search reads these points as Documents
+    points = [
+        models.PointStruct(
+            id=hashlib.md5(f"{doc_hash}:{text}".encode()).hexdigest(),
+            vector=embedding,
+            payload={
+                "name": name,
+                "meta_data": {"doc_hash": doc_hash, "page": page_number},
+                "content": text,
+                "usage": usage,
+                "content_hash": doc_hash
+            }
+        )
+        for (page_number, text), embedding, usage in zip(batch, embeddings, usages)
+    ]
+    await vector_db.async_client.upsert(collection_name=COLLECTION_NAME, points=points, wait=wait)
+
+async def index_chunks(vector_db: Qdrant, chunks: list[tuple[int, str]], name: str, doc_hash: str, wait: bool = True):
+    """Embed and upsert all batches concurrently, so one batch's embedding overlaps another's upsert"""
+    slots = asyncio.Semaphore(INGEST_WORKERS)
+
+    async def index_batch(batch):
+        async with slots:
+            await upsert_chunk_batch(vector_db, batch, name, doc_hash, wait)
+
+    results = await asyncio.gather(*[
+        index_batch(chunks[i:i + UPSERT_BATCH_SIZE])
+        for i in range(0, len(chunks), UPSERT_BATCH_SIZE)
+    ], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        # One stored point is enough for is_document_indexed to skip the file, so remove the partial write
+        await vector_db.async_client.delete(
+            collection_name=COLLECTION_NAME,
+            points_selector=models.FilterSelector(filter=models.Filter(must=[
+                models.FieldCondition(key="meta_data.doc_hash", match=models.MatchValue(value=doc_hash))
+            ])),
+            wait=True
+        )
+        raise errors[0]
+
+def document_hash(uploaded_file) -> str:
+    """Content hash of the uploaded file's bytes (BLAKE3 if installed, else SHA-256), used as its identity in Qdrant"""
+    hasher = blake3 if blake3 is not None else hashlib.sha256
+    return hasher(uploaded_file.getvalue()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _indexed_hashes() -> set:
+    """Content hashes this process has already seen in Qdrant"""
+    return set()
+
+def is_document_indexed(vector_db: Qdrant, doc_hash: str) -> bool:
+    """Check whether chunks with this content hash are already stored in Qdrant"""
+    if doc_hash in _indexed_hashes():
+        return True
+    if not vector_db.exists():
+        return False
+    points, _ = vector_db.client.scroll(
+        collection_name=COLLECTION_NAME,
+        scroll_filter=models.Filter(must=[
+            models.FieldCondition(key="meta_data.doc_hash", match=models.MatchValue(value=doc_hash))
+        ]),
+        limit=1,
+        with_payload=False,
+        with_vectors=False
+    )
+    # Only positive answers are remembered; a miss may be indexed a moment later
+    if points:
+        _indexed_hashes().add(doc_hash)
+    return bool(points)
+
+def prepare_chunks(pdf_bytes: bytes) -> list[tuple[int, str]]:
+    """Parsed, deduplicated chunks of one PDF, ready to embed"""
+    # Parsing is memoized on the file's bytes, so re-uploads skip straight to indexing
+    chunks = parse_chunks(pdf_bytes)
+    # Near-identical chunks would only cost embedding calls and storage
+    return dedupe_chunks(chunks)
+
+def process_documents(uploaded_files: dict, vector_db: Qdrant):
+    """
+    Process documents concurrently, create embeddings and store in Qdrant vector database
     
     Args:
-        uploaded_file: Streamlit uploaded file object
+        uploaded_files (dict): Streamlit uploaded file objects keyed by content hash
         vector_db (Qdrant): Initialized Qdrant instance from Agno
     
     Returns:
@@ -64,35 +535,62 @@ def process_document(uploaded_file, vector_db: Qdrant):
     if not st.session_state.openai_api_key:
         raise ValueError("OpenAI API key not provided")
         
-    os.environ['OPENAI_API_KEY'] = st.session_state.openai_api_key
+    set_openai_key_once()
     
     try:
-        # Save the uploaded file to a temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-            temp_file.write(uploaded_file.getvalue())
-            temp_file_path = temp_file.name
+        # Share one Knowledge base over the vector_db across uploads
+        knowledge_base = get_knowledge(vector_db)
         
-        st.info("Loading and processing document...")
+        # Skip embedding entirely for files whose bytes were indexed before
+        pending = {
+            doc_hash: uploaded_file for doc_hash, uploaded_file in uploaded_files.items()
+            if not is_document_indexed(vector_db, doc_hash)
+        }
+        if len(pending) < len(uploaded_files):
+            st.info(f"{len(uploaded_files) - len(pending)} document(s) already indexed, reusing stored embeddings.")
+        if not pending:
+            return knowledge_base
         
-        # Create a Knowledge base with the vector_db
-        knowledge_base = Knowledge(
-            vector_db=vector_db
-        )
+        st.info(f"Loading and processing {len(pending)} document(s)...")
         
-        # Add the document to the knowledge base
+        # Add the documents to the knowledge base
         with st.spinner('📤 Loading documents into knowledge base...'):
             try:
-                knowledge_base.add_content(path=temp_file_path)
+                indexing = []
+                # Threads rather than processes: PyMuPDF and the Numba kernels do the heavy lifting,
+                # and the cached parser and the script run context can't be shipped to another process
+                with ThreadPoolExecutor(
+                    max_workers=min(len(pending), os.cpu_count() or 1),
+                    initializer=add_script_run_ctx,
+                    initargs=(None, get_script_run_ctx())
+                ) as executor:
+                    parsing = {
+                        executor.submit(prepare_chunks, uploaded_file.getvalue()): doc_hash
+                        for doc_hash, uploaded_file in pending.items()
+                    }
+                    for future in as_completed(parsing):
+                        doc_hash = parsing[future]
+                        # Each file starts embedding as soon as it is parsed, while the rest are still parsing.
+                        # wait=False lets Qdrant acknowledge upserts before they are indexed
+                        indexing.append((doc_hash, asyncio.run_coroutine_threadsafe(
+                            index_chunks(vector_db, future.result(), pending[doc_hash].name, doc_hash, wait=False),
+                            _background_loop()
+                        )))
+                failures = []
+                for doc_hash, future in indexing:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failures.append(f"{pending[doc_hash].name}: {str(e)}")
+                    else:
+                        # Only a complete write marks the document as indexed
+                        _indexed_hashes().add(doc_hash)
+                if failures:
+                    raise Exception("; ".join(failures))
                 st.success("✅ Documents stored successfully!")
             except Exception as e:
                 st.error(f"Error loading documents: {str(e)}")
                 raise
-        
-        # Clean up the temporary file
-        try:
-            os.unlink(temp_file_path)
-        except Exception:
-            pass
             
         return knowledge_base
             
@@ -100,6 +598,235 @@ def process_document(uploaded_file, vector_db: Qdrant):
         st.error(f"Document processing error: {str(e)}")
         raise Exception(f"Error processing document: {str(e)}")
 
+@st.cache_resource(show_spinner=False)
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """Long-lived event loop, so pooled async connections outlive a single click"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_in_background(coro):
+    """Run a coroutine on the background loop and block until it finishes"""
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
+
+@st.cache_resource(show_spinner=False)
+def _shared_http_client() -> httpx.AsyncClient:
+    """One HTTP/2 connection pool shared by all agents running on the background loop"""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=HTTP_TIMEOUT
+    )
+
+@st.cache_resource(show_spinner=False)
+def _shared_sync_http_client() -> httpx.Client:
+    """HTTP/2 connection pool for the team lead, which streams synchronously on the script thread"""
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=HTTP_TIMEOUT
+    )
+
+class AsyncRateLimiter:
+    """Token bucket plus concurrency cap, so fanned-out agent runs stay under OpenAI's rate limits"""
+
+    def __init__(self, requests_per_second: float, max_bucket_size: int):
+        self.requests_per_second = requests_per_second
+        self.max_bucket_size = max_bucket_size
+        self._tokens = float(max_bucket_size)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_bucket_size)
+
+    async def _take_token(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.max_bucket_size, self._tokens + (now - self._updated) * self.requests_per_second)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.requests_per_second)
+
+    async def __aenter__(self):
+        await self._in_flight.acquire()
+        try:
+            await self._take_token()
+        except BaseException:
+            self._in_flight.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._in_flight.release()
+
+@st.cache_resource(show_spinner=False)
+def _rate_limiter() -> AsyncRateLimiter:
+    """Process-wide limiter shared by every session's agent runs"""
+    return AsyncRateLimiter(AGENT_REQUESTS_PER_SECOND, AGENT_MAX_BURST)
+
+async def _run_agent_limited(agent, query: str):
+    async with _rate_limiter():
+        return await agent.arun(query)
+
+async def _run_agents_async(agents, query: str):
+    """Run the given agents concurrently on the same query, returning exceptions in place of failed runs"""
+    return await asyncio.gather(
+        *[_run_agent_limited(agent, query) for agent in agents],
+        return_exceptions=True
+    )
+
+def run_agents_parallel(agents, query: str) -> list:
+    """
+    Run independent agents concurrently and return their outputs in order.
+
+    The agents are I/O-bound on model calls, so the wall time is the slowest
+    agent rather than the sum of all of them. They run on the shared background
+    loop so their pooled HTTP connections are reused across clicks. A failed
+    agent shows up as its exception, so one error doesn't discard the others.
+    """
+    return run_in_background(_run_agents_async(agents, query))
+
+def stream_team_content(run_stream):
+    """Yield the lead's markdown deltas from a streamed team run"""
+    for chunk in run_stream:
+        if chunk.event == TeamRunEvent.run_content and isinstance(chunk.content, str):
+            yield chunk.content
+
+def render_team_response(team: Team, prompt: str, text: str = None) -> str:
+    """Show an answer that is already available, or stream a fresh one from the team and return its text"""
+    if text is not None:
+        st.markdown(text)
+        return text
+    return st.write_stream(stream_team_content(team.run(prompt, stream=True)))
+
+def _cache_filter(document: str, analysis_type: str) -> models.Filter:
+    return models.Filter(must=[
+        models.FieldCondition(key="document", match=models.MatchValue(value=document)),
+        models.FieldCondition(key="analysis_type", match=models.MatchValue(value=analysis_type)),
+        # Entries older than the TTL are ignored, so stale analyses age out
+        models.FieldCondition(key="ts", range=models.Range(gte=time.time() - QA_CACHE_TTL_SECONDS))
+    ])
+
+def lookup_cached_analysis(vector_db: Qdrant, query_embedding: list, document: str, analysis_type: str):
+    """Return the cached analysis of a semantically similar question, if any"""
+    if not vector_db.client.collection_exists(QA_CACHE_COLLECTION):
+        return None
+    hits = vector_db.client.query_points(
+        collection_name=QA_CACHE_COLLECTION,
+        query=query_embedding,
+        query_filter=_cache_filter(document, analysis_type),
+        limit=1,
+        with_payload=True
+    ).points
+    if hits and hits[0].score >= QA_CACHE_THRESHOLD:
+        return hits[0].payload
+    return None
+
+def store_cached_analysis(vector_db: Qdrant, query_embedding: list, query: str, document: str, analysis_type: str, results: dict):
+    """Store a finished analysis so similar questions can skip the agent team"""
+    if not vector_db.client.collection_exists(QA_CACHE_COLLECTION):
+        vector_db.client.create_collection(
+            collection_name=QA_CACHE_COLLECTION,
+            vectors_config=models.VectorParams(size=len(query_embedding), distance=models.Distance.COSINE)
+        )
+    vector_db.client.upsert(
+        collection_name=QA_CACHE_COLLECTION,
+        points=[models.PointStruct(
+            id=str(uuid.uuid4()),
+            vector=query_embedding,
+            payload={
+                "query": query,
+                "document": document,
+                "analysis_type": analysis_type,
+                "ts": time.time(),
+                **results
+            }
+        )]
+    )
+
+LEGAL_AGENTS = ("Contract Analyst", "Legal Researcher", "Legal Strategist")
+
+@st.cache_resource(show_spinner=False, hash_funcs={Knowledge: id})
+def build_legal_agents(knowledge_base: Knowledge, openai_key: str, doc_hash: str) -> dict:
+    """Build the specialist agents once per knowledge base, key and document, reused across reruns"""
+    # Restrict every knowledge search to the chunks of this document
+    knowledge_filters = {"doc_hash": doc_hash}
+
+    legal_researcher = Agent(
+        name="Legal Researcher",
+        role="Legal research specialist",
+        model=OpenAIChat(id="gpt-5-mini", api_key=openai_key, http_client=_shared_http_client()),
+        tools=[DuckDuckGoTools()],
+        knowledge=knowledge_base,
+        search_knowledge=True,
+        knowledge_filters=knowledge_filters,
+        instructions=[
+            "Find and cite relevant legal cases and precedents",
+            "Provide detailed research summaries with sources",
+            "Reference specific sections from the uploaded document",
+            "Always search the knowledge base for relevant information"
+        ],
+        markdown=True
+    )
+
+    contract_analyst = Agent(
+        name="Contract Analyst",
+        role="Contract analysis specialist",
+        model=OpenAIChat(id="gpt-5-mini", api_key=openai_key, http_client=_shared_http_client()),
+        knowledge=knowledge_base,
+        search_knowledge=True,
+        knowledge_filters=knowledge_filters,
+        instructions=[
+            "Review contracts thoroughly",
+            "Identify key terms and potential issues",
+            "Reference specific clauses from the document"
+        ],
+        markdown=True
+    )
+
+    legal_strategist = Agent(
+        name="Legal Strategist", 
+        role="Legal strategy specialist",
+        model=OpenAIChat(id="gpt-5", api_key=openai_key, http_client=_shared_http_client()),
+        knowledge=knowledge_base,
+        search_knowledge=True,
+        knowledge_filters=knowledge_filters,
+        instructions=[
+            "Develop comprehensive legal strategies",
+            "Provide actionable recommendations",
+            "Consider both risks and opportunities"
+        ],
+        markdown=True
+    )
+
+    return {agent.name: agent for agent in [legal_researcher, contract_analyst, legal_strategist]}
+
+@st.cache_resource(show_spinner=False, hash_funcs={Knowledge: id})
+def build_legal_team(selected_agents: tuple, knowledge_base: Knowledge, openai_key: str, doc_hash: str) -> Team:
+    """Assemble a team lead over the selected agents, cached per selection and document"""
+    agents = build_legal_agents(knowledge_base, openai_key, doc_hash)
+    knowledge_filters = {"doc_hash": doc_hash}
+
+    # Legal Agent Team
+    return Team(
+        name="Legal Team Lead",
+        model=OpenAIChat(id="gpt-5", api_key=openai_key, http_client=_shared_sync_http_client()),
+        members=[agents[name] for name in selected_agents],
+        knowledge=knowledge_base,
+        search_knowledge=True,
+        knowledge_filters=knowledge_filters,
+        instructions=[
+            "Coordinate analysis between team members",
+            "Provide comprehensive responses",
+            "Ensure all recommendations are properly sourced",
+            "Reference specific parts of the uploaded document",
+            "Always search the knowledge base before delegating tasks"
+        ],
+        markdown=True
+    )
+
 def main():
     st.set_page_config(page_title="Legal Document Analyzer", layout="wide")
     init_session_state()
@@ -149,92 +876,53 @@ def main():
 
         if all([st.session_state.openai_api_key, st.session_state.vector_db]):
             st.header("📄 Document Upload")
-            uploaded_file = st.file_uploader("Upload Legal Document", type=['pdf'])
+            uploaded_files = st.file_uploader("Upload Legal Documents", type=['pdf'], accept_multiple_files=True)
             
-            if uploaded_file:
-                # Check if this file has already been processed
-                if uploaded_file.name not in st.session_state.processed_files:
-                    with st.spinner("Processing document..."):
+            if uploaded_files:
+                # Files are identified by content, so the same PDF uploaded twice is processed once
+                documents = {document_hash(uploaded_file): uploaded_file for uploaded_file in uploaded_files}
+                # Check which files have already been processed
+                new_documents = {
+                    doc_hash: uploaded_file for doc_hash, uploaded_file in documents.items()
+                    if doc_hash not in st.session_state.processed_files
+                }
+                if new_documents:
+                    with st.spinner("Processing documents..."):
                         try:
-                            # Process the document and get the knowledge base
-                            knowledge_base = process_document(uploaded_file, st.session_state.vector_db)
+                            # Process the documents and get the knowledge base
+                            knowledge_base = process_documents(new_documents, st.session_state.vector_db)
                             
                             if knowledge_base:
                                 st.session_state.knowledge_base = knowledge_base
-                                # Add the file to processed files
-                                st.session_state.processed_files.add(uploaded_file.name)
+                                # Add the files to processed files
+                                st.session_state.processed_files.update(new_documents)
                                 
-                                # Initialize agents
-                                legal_researcher = Agent(
-                                    name="Legal Researcher",
-                                    role="Legal research specialist",
-                                    model=OpenAIChat(id="gpt-5"),
-                                    tools=[DuckDuckGoTools()],
-                                    knowledge=st.session_state.knowledge_base,
-                                    search_knowledge=True,
-                                    instructions=[
-                                        "Find and cite relevant legal cases and precedents",
-                                        "Provide detailed research summaries with sources",
-                                        "Reference specific sections from the uploaded document",
-                                        "Always search the knowledge base for relevant information"
-                                    ],
-                                    debug_mode=True,
-                                    markdown=True
-                                )
-
-                                contract_analyst = Agent(
-                                    name="Contract Analyst",
-                                    role="Contract analysis specialist",
-                                    model=OpenAIChat(id="gpt-5"),
-                                    knowledge=st.session_state.knowledge_base,
-                                    search_knowledge=True,
-                                    instructions=[
-                                        "Review contracts thoroughly",
-                                        "Identify key terms and potential issues",
-                                        "Reference specific clauses from the document"
-                                    ],
-                                    markdown=True
-                                )
-
-                                legal_strategist = Agent(
-                                    name="Legal Strategist", 
-                                    role="Legal strategy specialist",
-                                    model=OpenAIChat(id="gpt-5"),
-                                    knowledge=st.session_state.knowledge_base,
-                                    search_knowledge=True,
-                                    instructions=[
-                                        "Develop comprehensive legal strategies",
-                                        "Provide actionable recommendations",
-                                        "Consider both risks and opportunities"
-                                    ],
-                                    markdown=True
-                                )
-
-                                # Legal Agent Team
-                                st.session_state.legal_team = Team(
-                                    name="Legal Team Lead",
-                                    model=OpenAIChat(id="gpt-5"),
-                                    members=[legal_researcher, contract_analyst, legal_strategist],
-                                    knowledge=st.session_state.knowledge_base,
-                                    search_knowledge=True,
-                                    instructions=[
-                                        "Coordinate analysis between team members",
-                                        "Provide comprehensive responses",
-                                        "Ensure all recommendations are properly sourced",
-                                        "Reference specific parts of the uploaded document",
-                                        "Always search the knowledge base before delegating tasks"
-                                    ],
-                                    debug_mode=True,
-                                    markdown=True
-                                )
-                                
-                                st.success("✅ Document processed and team initialized!")
+                                st.success("✅ Documents processed and team initialized!")
                                 
                         except Exception as e:
-                            st.error(f"Error processing document: {str(e)}")
+                            st.error(f"Error processing documents: {str(e)}")
+                else:
+                    # Files already processed, just show a message
+                    st.success("✅ Documents already processed and team ready!")
+
+                doc_hash = st.selectbox(
+                    "Document to Analyze",
+                    list(documents),
+                    format_func=lambda doc_hash: documents[doc_hash].name
+                )
+
+                if doc_hash in st.session_state.processed_files:
+                    # Agents and team are cached per knowledge base, key and document, and
+                    # only search the currently selected document's chunks
+                    st.session_state.legal_team = build_legal_team(
+                        LEGAL_AGENTS,
+                        st.session_state.knowledge_base,
+                        st.session_state.openai_api_key,
+                        doc_hash
+                    )
                 else:
-                    # File already processed, just show a message
-                    st.success("✅ Document already processed and team ready!")
+                    # Don't leave the previous document's team in place for one that failed to process
+                    st.session_state.legal_team = None
 
             st.divider()
             st.header("🔍 Analysis Options")
@@ -254,8 +942,10 @@ def main():
     # Main content area
     if not all([st.session_state.openai_api_key, st.session_state.vector_db]):
         st.info("👈 Please configure your API credentials in the sidebar to begin")
-    elif not uploaded_file:
+    elif not uploaded_files:
         st.info("👈 Please upload a legal document to begin analysis")
+    elif doc_hash not in st.session_state.processed_files:
+        st.info("👈 The selected document could not be processed yet. Re-upload it or select another document")
     elif st.session_state.legal_team:
         # Create a dictionary for analysis type icons
         analysis_icons = {
@@ -273,27 +963,32 @@ def main():
             "Contract Review": {
                 "query": "Review this contract and identify key terms, obligations, and potential issues.",
                 "agents": ["Contract Analyst"],
-                "description": "Detailed contract analysis focusing on terms and obligations"
+                "description": "Detailed contract analysis focusing on terms and obligations",
+                "synthesize": False
             },
             "Legal Research": {
                 "query": "Research relevant cases and precedents related to this document.",
                 "agents": ["Legal Researcher"],
-                "description": "Research on relevant legal cases and precedents"
+                "description": "Research on relevant legal cases and precedents",
+                "synthesize": False
             },
             "Risk Assessment": {
                 "query": "Analyze potential legal risks and liabilities in this document.",
                 "agents": ["Contract Analyst", "Legal Strategist"],
-                "description": "Combined risk analysis and strategic assessment"
+                "description": "Combined risk analysis and strategic assessment",
+                "synthesize": False
             },
             "Compliance Check": {
                 "query": "Check this document for regulatory compliance issues.",
                 "agents": ["Legal Researcher", "Contract Analyst", "Legal Strategist"],
-                "description": "Comprehensive compliance analysis"
+                "description": "Comprehensive compliance analysis",
+                "synthesize": True
             },
             "Custom Query": {
                 "query": None,
                 "agents": ["Legal Researcher", "Contract Analyst", "Legal Strategist"],
-                "description": "Custom analysis using all available agents"
+                "description": "Custom analysis using all available agents",
+                "synthesize": True
             }
         }
 
@@ -317,7 +1012,7 @@ def main():
                 with st.spinner("Analyzing document..."):
                     try:
                         # Ensure OpenAI API key is set
-                        os.environ['OPENAI_API_KEY'] = st.session_state.openai_api_key
+                        set_openai_key_once()
                         
                         # Combine predefined and user queries
                         if analysis_type != "Custom Query":
@@ -339,51 +1034,103 @@ def main():
                             Focus Areas: {', '.join(analysis_configs[analysis_type]['agents'])}
                             """
 
-                        response: RunOutput = st.session_state.legal_team.run(combined_query)
+                        # Check the semantic cache before running the agent team
+                        vector_db = st.session_state.vector_db
+                        # A team over just this analysis' agents, cached per selection
+                        legal_team = build_legal_team(
+                            tuple(sorted(analysis_configs[analysis_type]['agents'])),
+                            st.session_state.knowledge_base,
+                            st.session_state.openai_api_key,
+                            doc_hash
+                        )
+                        cache_query = user_query if analysis_type == "Custom Query" else analysis_configs[analysis_type]['query']
+                        # The cache is best-effort: any failure falls through to a normal run
+                        cached = {}
+                        try:
+                            query_embedding = vector_db.embedder.get_embedding(cache_query)
+                            # A failed embedding request comes back empty
+                            if query_embedding:
+                                cached = lookup_cached_analysis(vector_db, query_embedding, doc_hash, analysis_type) or {}
+                        except Exception as e:
+                            query_embedding = None
+                            st.caption(f"Semantic cache unavailable: {str(e)}")
+
+                        analysis = cached.get("analysis")
+                        synthesis_query = None
+                        partial = False
+                        if cached:
+                            st.caption("⚡ Reusing the analysis of a similar previous question")
+                        else:
+                            # Only the agents this analysis needs run, all of them concurrently
+                            active_agents = legal_team.members
+                            member_responses = run_agents_parallel(active_agents, combined_query)
+                            completed = []
+                            for agent, member_response in zip(active_agents, member_responses):
+                                if isinstance(member_response, Exception):
+                                    st.warning(f"{agent.name} failed: {str(member_response)}")
+                                else:
+                                    completed.append((agent, member_response))
+                            if not completed:
+                                raise Exception("All agents failed to analyze the document")
+                            partial = len(completed) < len(active_agents)
+                            member_analyses = "\n\n---\n\n".join(
+                                f"## {agent.name}\n{member_response.content or ''}"
+                                for agent, member_response in completed
+                            )
+                            if not analysis_configs[analysis_type]['synthesize']:
+                                # The agents' roles don't overlap, so their outputs are shown as-is
+                                analysis = member_analyses
+                            else:
+                                synthesis_query = f"""Your team members have already analyzed the task below.
+                                Synthesize their analyses into a single comprehensive response without delegating again.
+
+                                Task:
+                                {combined_query}
+
+                                Team member analyses:
+                                {member_analyses}"""
                         
-                        # Display results in tabs
+                        # Display results in tabs, streaming fresh answers as they are generated
                         tabs = st.tabs(["Analysis", "Key Points", "Recommendations"])
                         
                         with tabs[0]:
                             st.markdown("### Detailed Analysis")
-                            if response.content:
-                                st.markdown(response.content)
-                            else:
-                                for message in response.messages:
-                                    if message.role == 'assistant' and message.content:
-                                        st.markdown(message.content)
+                            analysis = render_team_response(legal_team, synthesis_query, analysis)
                         
                         with tabs[1]:
                             st.markdown("### Key Points")
-                            key_points_response: RunOutput = st.session_state.legal_team.run(
+                            key_points = render_team_response(
+                                legal_team,
                                 f"""Based on this previous analysis:    
-                                {response.content}
+                                {analysis}
                                 
                                 Please summarize the key points in bullet points.
-                                Focus on insights from: {', '.join(analysis_configs[analysis_type]['agents'])}"""
+                                Focus on insights from: {', '.join(analysis_configs[analysis_type]['agents'])}""",
+                                cached.get("key_points")
                             )
-                            if key_points_response.content:
-                                st.markdown(key_points_response.content)
-                            else:
-                                for message in key_points_response.messages:
-                                    if message.role == 'assistant' and message.content:
-                                        st.markdown(message.content)
                         
                         with tabs[2]:
                             st.markdown("### Recommendations")
-                            recommendations_response: RunOutput = st.session_state.legal_team.run(
+                            recommendations = render_team_response(
+                                legal_team,
                                 f"""Based on this previous analysis:
-                                {response.content}
+                                {analysis}
                                 
                                 What are your key recommendations based on the analysis, the best course of action?
-                                Provide specific recommendations from: {', '.join(analysis_configs[analysis_type]['agents'])}"""
+                                Provide specific recommendations from: {', '.join(analysis_configs[analysis_type]['agents'])}""",
+                                cached.get("recommendations")
                             )
-                            if recommendations_response.content:
-                                st.markdown(recommendations_response.content)
-                            else:
-                                for message in recommendations_response.messages:
-                                    if message.role == 'assistant' and message.content:
-                                        st.markdown(message.content)
+
+                        # A degraded answer from a partial team must not be served to later questions
+                        if not cached and not partial and query_embedding:
+                            try:
+                                store_cached_analysis(vector_db, query_embedding, cache_query, doc_hash, analysis_type, {
+                                    "analysis": analysis,
+                                    "key_points": key_points,
+                                    "recommendations": recommendations
+                                })
+                            except Exception as e:
+                                st.caption(f"Could not cache this analysis: {str(e)}")
 
                     except Exception as e:
                         st.error(f"Error during analysis: {str(e)}")
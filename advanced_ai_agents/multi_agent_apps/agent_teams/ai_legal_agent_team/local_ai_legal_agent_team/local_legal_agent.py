@@ -1,37 +1,348 @@
 import streamlit as st
 from agno.agent import Agent
 from agno.team import Team
-from agno.run.agent import RunOutput
+from agno.run.team import TeamRunEvent
 from agno.knowledge.knowledge import Knowledge
 from agno.vectordb.qdrant import Qdrant
 from agno.models.ollama import Ollama
 from agno.knowledge.embedder.ollama import OllamaEmbedder
-import tempfile
+from agno.knowledge.reader.base import Reader
+from agno.knowledge.document.base import Document
+import fitz  # PyMuPDF
+import httpx
+import ollama
+import numpy as np
+import io
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+import diskcache
+from qdrant_client import models
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
 
 
 # -------------------------
 # INIT
 # -------------------------
+COLLECTION_NAME = "legal_knowledge"
+OCR_MIN_CHARS = 50  # pages with less text than this are treated as scanned (same as the main app)
+OCR_DPI = 200
+QUERY_CACHE_DIR = os.path.expanduser("~/.cache/legalteam/qemb")
+QUERY_CACHE_SIZE_LIMIT = 1 << 26  # bytes on disk
+INGESTING = ContextVar("ingesting", default=False)  # chunk embeddings skip the query cache
+
+
+def text_hash(text):
+    hasher = blake3 if blake3 is not None else hashlib.sha256
+    return hasher(text.encode()).hexdigest()
+
+
+@dataclass
+class CachedOllamaEmbedder(OllamaEmbedder):
+    # Repeated queries skip Ollama: an in-memory LRU on the cached instance, backed by a size-limited disk cache.
+    # Ingestion sends whole batches to Ollama's /api/embed through the pooled async client
+    query_cache_size: int = 1024
+
+    def __post_init__(self):
+        if hasattr(super(), "__post_init__"):
+            super().__post_init__()
+        # OllamaEmbedder turns batching off; this class implements it
+        self.enable_batch = True
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = diskcache.Cache(QUERY_CACHE_DIR, size_limit=QUERY_CACHE_SIZE_LIMIT)
+
+    async def async_get_embeddings_batch_and_usage(self, texts):
+        embeddings, usages = [], []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            try:
+                # Same request agno makes for single texts, with the whole batch as input
+                response = await self.aclient.embed(model=self.id, input=batch, dimensions=self.dimensions)
+                embeddings.extend(response["embeddings"])
+                usages.extend([None] * len(batch))
+            except Exception:
+                # One bad batch falls back to single requests instead of failing the whole document
+                for text in batch:
+                    embedding, usage = await super().async_get_embedding_and_usage(text)
+                    embeddings.append(embedding)
+                    usages.append(usage)
+        return embeddings, usages
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key].tolist()
+        return None
+
+    def _remember(self, key, embedding):
+        # float32 arrays take a fraction of the memory of 4096-float lists
+        with self._lock:
+            self._memory[key] = np.asarray(embedding, dtype=np.float32)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.query_cache_size:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        embedding = self._disk.get(key)
+        return None if embedding is None else embedding.tolist()
+
+    def _disk_set(self, key, embedding):
+        self._disk.set(key, np.asarray(embedding, dtype=np.float32))
+
+    def get_embedding(self, text):
+        if INGESTING.get():
+            return super().get_embedding(text)
+        key = f"{self.id}:{text_hash(text)}"
+        embedding = self._lookup(key)
+        if embedding is None:
+            embedding = self._disk_get(key)
+            if embedding is None:
+                embedding = super().get_embedding(text)
+                if embedding:
+                    self._disk_set(key, embedding)
+            if embedding:
+                self._remember(key, embedding)
+        return embedding
+
+    async def async_get_embedding(self, text):
+        if INGESTING.get():
+            return await super().async_get_embedding(text)
+        key = f"{self.id}:{text_hash(text)}"
+        embedding = self._lookup(key)
+        if embedding is None:
+            # diskcache is blocking SQLite, keep it off the event loop
+            embedding = await asyncio.to_thread(self._disk_get, key)
+            if embedding is None:
+                embedding = await super().async_get_embedding(text)
+                if embedding:
+                    await asyncio.to_thread(self._disk_set, key, embedding)
+            if embedding:
+                self._remember(key, embedding)
+        return embedding
+
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_client():
+    # One keep-alive pool for all model and embedding calls; agno otherwise opens a new client per request.
+    # Plain-HTTP Ollama can't negotiate HTTP/2, so this pools HTTP/1.1 connections
+    return ollama.AsyncClient(
+        host="http://localhost:11434",
+        timeout=120.0,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+    )
+
+
+@st.cache_resource(show_spinner=False)
 def get_vector_db():
-    return Qdrant(
-        collection="legal_knowledge",
+    vector_db = Qdrant(
+        collection=COLLECTION_NAME,
         url="http://localhost:6333",
-        embedder=OllamaEmbedder(model="openhermes"),
+        prefer_grpc=True,
+        grpc_port=6334,
+        embedder=CachedOllamaEmbedder(id="openhermes", batch_size=256, async_client=get_ollama_client()),
+    )
+    # Large Ollama embeddings hold up well under 1-bit quantization (~32x less RAM per vector)
+    vector_db.create()
+    vector_db.client.update_collection(
+        collection_name=COLLECTION_NAME,
+        hnsw_config=models.HnswConfigDiff(m=32, ef_construct=256),
+        quantization_config=models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True)
+        ),
+    )
+    vector_db.client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="meta_data.doc_hash",
+        field_schema=models.PayloadSchemaType.KEYWORD,
+    )
+    return vector_db
+
+
+@st.cache_resource(show_spinner=False, hash_funcs={Qdrant: id})
+def get_knowledge(vector_db):
+    return Knowledge(vector_db=vector_db)
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    # One long-lived loop, so the cached async Qdrant client is always used from the loop it was opened on
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+def file_hash(uploaded_file):
+    hasher = blake3() if blake3 is not None else hashlib.sha256()
+    uploaded_file.seek(0)
+    for block in iter(lambda: uploaded_file.read(1 << 20), b""):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def indexed_hashes():
+    # Hashes confirmed in Qdrant by this process, so reruns skip the lookup
+    return set()
+
+
+async def is_indexed(vector_db, doc_hash):
+    if doc_hash in indexed_hashes():
+        return True
+    # Async client calls, so the lookup doesn't block the shared background loop
+    if not await vector_db.async_client.collection_exists(COLLECTION_NAME):
+        return False
+    points, _ = await vector_db.async_client.scroll(
+        collection_name=COLLECTION_NAME,
+        scroll_filter=models.Filter(must=[
+            models.FieldCondition(key="meta_data.doc_hash", match=models.MatchValue(value=doc_hash))
+        ]),
+        limit=1,
     )
+    if points:
+        indexed_hashes().add(doc_hash)
+    return bool(points)
 
 
-def ingest_pdf(uploaded_file, vector_db):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(uploaded_file.getvalue())
-        path = tmp.name
+def ocr_png(png_bytes):
+    return pytesseract.image_to_string(Image.open(io.BytesIO(png_bytes)))
 
-    kb = Knowledge(vector_db=vector_db)
-    kb.add_content(path=path)
-    os.unlink(path)
+
+class PyMuPDFReader(Reader):
+    # Parses from an in-memory stream, so uploads never touch disk; ~10x faster than pypdf on hard PDFs
+    def read(self, pdf, name=None):
+        with fitz.open(stream=pdf.read(), filetype="pdf") as doc:
+            texts = [page.get_text() for page in doc]
+            # Only pages without a text layer are OCRed (if pytesseract is installed)
+            scanned = [i for i, text in enumerate(texts) if len(text.strip()) < OCR_MIN_CHARS]
+            if scanned and pytesseract is not None:
+                images = [doc[i].get_pixmap(dpi=OCR_DPI).tobytes("png") for i in scanned]
+                with ThreadPoolExecutor() as executor:
+                    for i, text in zip(scanned, executor.map(ocr_png, images)):
+                        texts[i] = text
+
+        documents = [
+            Document(
+                name=name,
+                id=f"{name}_{page_number}",
+                meta_data={"page": page_number},
+                content=text,
+            )
+            for page_number, text in enumerate(texts, start=1)
+        ]
+        if not self.chunk:
+            return documents
+        return [chunk for document in documents for chunk in self.chunk_document(document)]
+
+
+async def upsert_documents(vector_db, documents, doc_hash):
+    embeddings, usages = await vector_db.embedder.async_get_embeddings_batch_and_usage(
+        [document.content for document in documents]
+    )
+    failed = sum(1 for embedding in embeddings if not embedding)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(documents)} chunks could not be embedded")
+    # Same payload as agno's Qdrant insert, but the id includes doc_hash: agno's md5(content) id lets
+    # boilerplate shared by two documents overwrite the other's point (and its doc_hash)
+    points = [
+        models.PointStruct(
+            id=hashlib.md5(f"{doc_hash}:{document.content}".encode()).hexdigest(),
+            vector=embedding,
+            payload={
+                "name": document.name,
+                "meta_data": document.meta_data,
+                "content": document.content,
+                "usage": usage,
+                "content_hash": doc_hash,
+            },
+        )
+        for document, embedding, usage in zip(documents, embeddings, usages)
+    ]
+    for i in range(0, len(points), 256):
+        await vector_db.async_client.upsert(collection_name=COLLECTION_NAME, points=points[i:i + 256])
+
+
+async def ingest_pdf_async(uploaded_file, vector_db, doc_hash):
+    kb = get_knowledge(vector_db)
+    # The same bytes were embedded before (in any session), reuse them
+    if await is_indexed(vector_db, doc_hash):
+        return kb
+
+    # The upload is already an in-memory buffer; reading it from the start hands PyMuPDF
+    # the same bytes object rather than a copy
+    uploaded_file.seek(0)
+    # Parsing and OCR run in a worker thread so they don't stall other sessions on the shared loop
+    documents = await asyncio.to_thread(PyMuPDFReader().read, uploaded_file, uploaded_file.name)
+    for document in documents:
+        document.meta_data["doc_hash"] = doc_hash
+    # Embedding and upserts go through the async Ollama and Qdrant clients; only queries are cached
+    INGESTING.set(True)
+    await upsert_documents(vector_db, documents, doc_hash)
+    indexed_hashes().add(doc_hash)
     return kb
 
 
+@st.cache_resource(show_spinner=False, hash_funcs={Knowledge: id})
+def build_team(kb, doc_hash):
+    # Built once per knowledge base and document instead of on every rerun
+    model = Ollama(id="llama3.1:8b", async_client=get_ollama_client())
+    # Every search is restricted to the chunks of this document
+    filters = {"doc_hash": doc_hash}
+
+    return Team(
+        name="Legal Team",
+        model=model,
+        knowledge=kb,
+        search_knowledge=True,
+        knowledge_filters=filters,
+        # Every member gets the task at once; with arun they run concurrently instead of one after another
+        delegate_task_to_all_members=True,
+        members=[
+            Agent(name="Legal Researcher", model=model, knowledge=kb, search_knowledge=True, knowledge_filters=filters),
+            Agent(name="Contract Analyst", model=model, knowledge=kb, search_knowledge=True, knowledge_filters=filters),
+            Agent(name="Legal Strategist", model=model, knowledge=kb, search_knowledge=True, knowledge_filters=filters),
+        ],
+        markdown=True,
+    )
+
+
+def iterate_async(async_iterator):
+    # Pulls an async stream from the background loop into a plain generator for st.write_stream
+    loop = get_event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def stream_content(run_stream):
+    # Only the team's own answer, not member or tool events
+    for event in run_stream:
+        if event.event == TeamRunEvent.run_content and isinstance(event.content, str):
+            yield event.content
+
+
 # -------------------------
 # APP
 # -------------------------
@@ -47,30 +358,14 @@ def main():
         st.info("Upload a document to start")
         return
 
-    kb = ingest_pdf(uploaded_file, vector_db)
-
-    # -------- AGENTS --------
-    model = Ollama(id="llama3.1:8b")
-
-    team = Team(
-        name="Legal Team",
-        model=model,
-        knowledge=kb,
-        search_knowledge=True,
-        members=[
-            Agent("Legal Researcher", model=model, knowledge=kb, search_knowledge=True),
-            Agent("Contract Analyst", model=model, knowledge=kb, search_knowledge=True),
-            Agent("Legal Strategist", model=model, knowledge=kb, search_knowledge=True),
-        ],
-        markdown=True,
-    )
+    doc_hash = file_hash(uploaded_file)
+    kb = run_async(ingest_pdf_async(uploaded_file, vector_db, doc_hash))
+    team = build_team(kb, doc_hash)
 
     query = st.text_area("Ask a question about the document")
 
     if st.button("Analyze") and query:
-        with st.spinner("Analyzing…"):
-            response: RunOutput = team.run(query)
-            st.markdown(response.content or "")
+        st.write_stream(stream_content(iterate_async(team.arun(query, stream=True))))
 
 
 if __name__ == "__main__":
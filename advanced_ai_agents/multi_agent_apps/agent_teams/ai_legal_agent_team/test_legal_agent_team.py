@@ -0,0 +1,48 @@
+"""
+Regression tests for the chunking and deduplication in legal_agent_team.py
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+legal_agent_team = pytest.importorskip("legal_agent_team")
+
+
+def _word_hashes(text):
+    return np.fromiter(
+        (legal_agent_team._word_hash(word) for word in text.lower().split()),
+        dtype=np.uint64,
+    )
+
+
+def _high_bit_chunk():
+    """A chunk whose SimHash fingerprint is >= 2**63"""
+    for i in range(1000):
+        text = f"The supplier shall indemnify the buyer under clause {i} of this agreement."
+        if int(legal_agent_team.simhash(_word_hashes(text))) >= 2**63:
+            return text
+    pytest.fail("no chunk with the high fingerprint bit set")
+
+
+def test_near_duplicate_accepts_high_bit_fingerprints():
+    fingerprint = np.uint64(2**63 | 0b101)
+    seen = np.array([np.uint64(2**63 | 0b100)], dtype=np.uint64)
+    assert legal_agent_team.is_near_duplicate(fingerprint, seen, 1, 3)
+    assert not legal_agent_team.is_near_duplicate(~fingerprint, seen, 1, 3)
+
+
+def test_dedupe_chunks_with_high_bit_fingerprint():
+    text = _high_bit_chunk()
+    other = "Either party may terminate this agreement with thirty days written notice to the other."
+    chunks = [(1, text), (2, text), (3, other)]
+    assert legal_agent_team.dedupe_chunks(chunks) == [(1, text), (3, other)]
+
+
+def test_split_sentences_repeats_trailing_sentences():
+    sentences = [f"Clause {i} binds the parties. " for i in range(40)]
+    chunks = legal_agent_team.split_sentences("".join(sentences), chunk_size=300, overlap=60)
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        last_sentence = previous.rsplit(". ", 1)[-1]
+        assert last_sentence in chunk
+        assert len(chunk) <= 300